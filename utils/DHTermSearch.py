@@ -1,14 +1,69 @@
-import numpy as np
 import pandas as pd
 import requests
 import json
-import bs4
+import copy
+import sqlite3
+import time
+import warnings
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from lxml import etree
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# shared session so paged/repeated queries reuse connections (keep-alive)
+_SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20,
+                       max_retries=Retry(total=3, backoff_factor=0.5,
+                                         status_forcelist=(429, 500, 502, 503, 504),
+                                         # efetch POSTs are idempotent, retry them too
+                                         allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"}))
+_SESSION.mount("https://", _adapter)
+_SESSION.mount("http://", _adapter)
+_SESSION.headers.update({"User-Agent": "DHTermSearch/1.0"})
+
+# compiled once, string() joins text in libxml2 and returns "" if there is no match
+# smart_strings=False returns plain str that doesn't keep the parsed article alive
+_X_BODY = etree.XPath("string(.//body)", smart_strings=False)
+_X_ABSTRACT = etree.XPath("string(.//abstract)", smart_strings=False)
+_X_TITLE = etree.XPath("string(.//article-title)", smart_strings=False)
+_X_PMC_ID = etree.XPath("string(.//article-id[@pub-id-type='pmc'])", smart_strings=False)
+
+# seconds before cached query results are refreshed
+_CACHE_TTL = 3600
+
+# on-disk cache of parsed PMC articles, persists across sessions
+_PMC_CACHE_PATH = "pmc_parsed.sqlite"
+_PMC_CACHE_TTL = 7 * 24 * 3600
+
+def _ttl_hash():
+    """
+    Returns a value that changes every _CACHE_TTL seconds, used to expire lru_cache entries
+    """
+    return int(time.time() // _CACHE_TTL)
+
+def _fetch_page(study_url, params, curr_min, curr_max):
+    """
+    Retrieve a single page (min_rnk to max_rnk) of ClinicalTrials.gov results
+    """
+    page_params = dict(params, min_rnk=curr_min, max_rnk=curr_max)
+    r = _SESSION.get(study_url, params=page_params, timeout=30)
+
+    return r.json()["StudyFieldsResponse"]
+
+def _clean_record(record):
+    """
+    Join list values with tabs and replace missing values with "" for a single study record
+    """
+    return {k: "\t".join(v) if isinstance(v, list) else ("" if v is None else v) 
+            for k, v in record.items()}
 
 def query_ctgov_api(query, return_fields, verbose=False, n_lim=None, 
                            study_url = "https://ClinicalTrials.gov/api/query/study_fields?", search_field=None):
     """
     Retrieve data from ClinicalTrials.gov
     Search ClinicalTrials.gov data using requests
+    Repeated searches within _CACHE_TTL seconds are served from an in-memory cache
     
     Params:
         query (str): text query
@@ -19,6 +74,24 @@ def query_ctgov_api(query, return_fields, verbose=False, n_lim=None,
         // verbose (bool): print query numbers
         
     """
+    # lists aren't hashable, convert to tuples for the cache key
+    if isinstance(search_field, list): 
+        search_field = tuple(search_field)
+
+    clinical_df = _query_ctgov_api(query, tuple(return_fields), n_lim, study_url, 
+                                   search_field, _ttl_hash())
+
+    # return a copy so callers can't modify the cached dataframe
+    if isinstance(clinical_df, pd.DataFrame):
+        clinical_df = clinical_df.copy()
+
+    return clinical_df
+
+@lru_cache(maxsize=128)
+def _query_ctgov_api(query, return_fields, n_lim, study_url, search_field, ttl_hash):
+    """
+    Cached implementation of query_ctgov_api, ttl_hash expires entries after _CACHE_TTL seconds
+    """
 
     # search for clinical trials and get data
     if len(query)==0: 
@@ -28,10 +101,10 @@ def query_ctgov_api(query, return_fields, verbose=False, n_lim=None,
         return("Too many search results to return! Max 20")
 
     
-    # first search
-    clinical_df = pd.DataFrame()
+    # first search, don't request more than n_lim records per page
+    page_size = 1000 if n_lim is None else max(1, min(1000, n_lim))
     curr_min = 1
-    curr_max = 1000
+    curr_max = page_size
 
     # this is a little confusing but
     # "fields"=which fields to return results for ="return_fields"
@@ -39,20 +112,16 @@ def query_ctgov_api(query, return_fields, verbose=False, n_lim=None,
     params = {"expr":query,
                 "fmt":"JSON", 
                 "fields" : ",".join(return_fields),
-                "min_rnk":curr_min,
-                "max_rnk":curr_max
             }
     if search_field is not None: params["field"] = search_field
 
-    r = requests.get(study_url, params)
+    info = _fetch_page(study_url, params, curr_min, curr_max)
     #if len(r.text) < 1000: st.write(r.text) # QA 
-    info = r.json()
 
     # get total number of studies
-    if info["StudyFieldsResponse"]["NStudiesReturned"]>0:
-        n_total = info["StudyFieldsResponse"]["NStudiesFound"]
-        info = info['StudyFieldsResponse']["StudyFields"]
-        clinical_df = pd.DataFrame(info)
+    if info["NStudiesReturned"]>0:
+        n_total = info["NStudiesFound"]
+        all_records = [_clean_record(record) for record in info["StudyFields"]]
     else:
         
         return "No studies found"
@@ -60,50 +129,50 @@ def query_ctgov_api(query, return_fields, verbose=False, n_lim=None,
     if n_lim is not None: 
         n_total = min(n_total, n_lim)
 
-    if n_total > curr_max:
-        while n_total > curr_max:
-            curr_min = curr_min + 999
-            curr_max = min(n_total, curr_max + 999)
+    # remaining pages are independent, so fetch them concurrently
+    ranges = []
+    while n_total > curr_max:
+        curr_min = curr_min + page_size
+        curr_max = min(n_total, curr_max + page_size)
+        ranges.append((curr_min, curr_max))
 
-            # get new data
-            params = {"expr":query,
-                "fmt":"JSON", 
-                "fields" : ",".join(return_fields),
-                "min_rnk":curr_min,
-                "max_rnk":curr_max
-            }
-            if search_field is not None: params["field"] = search_field
+    if len(ranges) > 0:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            pages = executor.map(lambda rnk: _fetch_page(study_url, params, *rnk), ranges)
 
-            r = requests.get(study_url, params)
-            info = r.json()
+            # collect records in page order, build dataframe once after paging
+            for info in pages:
+                if info["NStudiesReturned"]>0:
+                    all_records.extend(_clean_record(record) for record in info["StudyFields"])
 
-            # append to dataframe
-            if info["StudyFieldsResponse"]["NStudiesReturned"]>0:
-                info = info['StudyFieldsResponse']["StudyFields"]
-                curr_df = pd.DataFrame(info)
-                clinical_df = pd.concat([clinical_df, curr_df])
-
-            #if verbose: st.write("%d/%d records retrieved"%(curr_max,n_total))
+        #if verbose: st.write("%d/%d records retrieved"%(curr_max,n_total))
     #else:
         #if verbose:  st.write("%d records retrieved"%n_total)
 
-    # clean up values
-    del clinical_df["Rank"]
-    clinical_df = clinical_df.replace(np.nan, "")
-    clinical_df = clinical_df.replace("\t", ' ')
-    clinical_df = clinical_df.replace("\n", ' ')
-    clinical_df = clinical_df.applymap(lambda x: "\t".join(x) if type(x)==list else x)
-    clinical_df = clinical_df.replace(np.nan, "")
-
-    # drop duplicates
-    #clinical_df = clinical_df.set_index("NCTId")
-    clinical_df = clinical_df.drop_duplicates()
+    # clean up values, lists and missing values were handled by _clean_record
+    clinical_df = pd.DataFrame(all_records)
+    clinical_df = clinical_df.drop(columns="Rank", errors="ignore")
+    clinical_df = clinical_df.replace({"\t":" ", "\n":" "})
 
     return clinical_df
 
 def get_pmc_ids(query, search_params):
     """
     Uses eutils to retrieve PMC abstracts from a search
+    Repeated searches within _CACHE_TTL seconds are served from an in-memory cache
+    """
+    # lists aren't hashable, convert to tuples for the cache key
+    search_params = tuple(sorted((k, tuple(v) if isinstance(v, list) else v) 
+                                 for k, v in search_params.items()))
+    search_data = _get_pmc_ids(query, search_params, _ttl_hash())
+
+    # return a copy so callers can't modify the cached response
+    return copy.deepcopy(search_data)
+
+@lru_cache(maxsize=128)
+def _get_pmc_ids(query, search_params, ttl_hash):
+    """
+    Cached implementation of get_pmc_ids, search_params is a tuple of (key, value) pairs
     """
     base_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
 
@@ -114,46 +183,141 @@ def get_pmc_ids(query, search_params):
         "retmode":"json",
         "retmax": 9999
     }
-    search_payload.update(search_params)
+    search_payload.update(dict(search_params))
     
-    search_response = requests.get(base_url+"esearch.fcgi", params=search_payload)
+    search_response = _SESSION.get(base_url+"esearch.fcgi", params=search_payload, timeout=30)
     search_data = search_response.json()
     
     return search_data
 
-def fetch_full_pmc_text(uid_list):
+def fetch_full_pmc_text(uid_list, cache_path=_PMC_CACHE_PATH, api_key=None, batch_size=200):
+    """
+    Uses eutils to retrieve full text, title, and abstract of PMC articles
+    Parsed articles are stored on disk in cache_path (sqlite), one row per UID, for 
+    _PMC_CACHE_TTL seconds; only UIDs missing from the cache are downloaded
+    Set cache_path=None to always re-download
+    UIDs are fetched in batches of batch_size, an NCBI api_key raises the rate limit
+    """
+    if cache_path is None:
+        return _fetch_full_pmc_text(uid_list, api_key, batch_size)
+
+    uid_list = [str(uid) for uid in uid_list]
+    conn = sqlite3.connect(cache_path)
+    try:
+        conn.execute("CREATE TABLE IF NOT EXISTS articles "
+                     "(uid TEXT PRIMARY KEY, cached_time REAL, article TEXT)")
+
+        # look up cached articles, in groups to stay under sqlite's variable limit
+        articles = {}
+        min_time = time.time() - _PMC_CACHE_TTL
+        for i in range(0, len(uid_list), 500):
+            uids = uid_list[i:i+500]
+            rows = conn.execute("SELECT uid, article FROM articles WHERE cached_time > ? AND uid IN (%s)"
+                                %",".join("?"*len(uids)), [min_time] + uids)
+            articles.update((uid, json.loads(article)) for uid, article in rows)
+
+        # save each batch as soon as it finishes so progress isn't lost on failure
+        def cache_batch(chunk_values):
+            conn.executemany("INSERT OR REPLACE INTO articles VALUES (?, ?, ?)", 
+                             [(_pmc_uid(values["pmc_id"]), time.time(), json.dumps(values)) 
+                              for values in chunk_values if values["pmc_id"] != ""])
+            conn.commit()
+
+        missing = [uid for uid in uid_list if uid not in articles]
+        fetched = []
+        if len(missing) > 0:
+            fetched = _fetch_full_pmc_text(missing, api_key, batch_size, on_batch=cache_batch)
+    finally:
+        conn.close()
+
+    # return articles in uid_list order, then any fetched article not matching a requested UID
+    for values in fetched:
+        articles.setdefault(_pmc_uid(values["pmc_id"]), values)
+    requested = set(uid_list)
+    values_dict = [articles[uid] for uid in dict.fromkeys(uid_list) if uid in articles]
+    values_dict.extend(values for values in fetched if _pmc_uid(values["pmc_id"]) not in requested)
+
+    return values_dict
+
+def _pmc_uid(pmc_id):
+    """
+    Convert a PMC id from the article XML ("PMC123" or "123") to an eutils UID ("123")
+    """
+    return pmc_id[3:] if pmc_id.upper().startswith("PMC") else pmc_id
+
+def _fetch_full_pmc_text(uid_list, api_key=None, batch_size=200, on_batch=None):
+    """
+    Fetch and parse PMC articles, batches of uid_list are fetched concurrently
+    A failed batch doesn't stop the others, the UIDs of failed batches are listed in a warning
+    on_batch(chunk_values) is called with the articles of each batch as it finishes
+    """
+    uid_list = list(uid_list)
+    chunks = [uid_list[i:i+batch_size] for i in range(0, len(uid_list), batch_size)]
+
+    # each worker streams and parses its own batch, lxml releases the GIL while
+    # parsing so batches are also parsed in parallel
+    chunk_values = [[] for _ in chunks]
+    failed = []
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = {executor.submit(_fetch_pmc_chunk, chunk, api_key): i for i, chunk in enumerate(chunks)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                chunk_values[i] = future.result()
+            except Exception as e: # keep other batches, report this one below
+                failed.append((chunks[i], e))
+                continue
+
+            if on_batch is not None: 
+                on_batch(chunk_values[i])
+
+    if len(failed) > 0:
+        failed_uids = [str(uid) for chunk, _ in failed for uid in chunk]
+        warnings.warn("Failed to fetch %d PMC articles (%s): %s"%(len(failed_uids), 
+                      "; ".join(str(e) for _, e in failed), ",".join(failed_uids)))
+
+    values_dict = [values for chunk in chunk_values for values in chunk]
+
+    return values_dict
+
+def _fetch_pmc_chunk(uid_list, api_key=None):
+    """
+    Fetch and parse a single batch of PMC articles
+    """
     base_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
     fetch_url = base_url + "efetch.fcgi"
 
     # Fetch the full text of articles using the UID list
+    # POST avoids URL length limits for long UID lists
     fetch_payload = {
         "db": "pmc",
-        "id": ",".join(uid_list),
+        "id": ",".join(str(uid) for uid in uid_list),
         "retmode": "xml",
         "rettype": "full"
     }
-    fetch_response = requests.get(fetch_url, params=fetch_payload)
+    if api_key is not None: fetch_payload["api_key"] = api_key
 
-    # Convert XML response to JSON
-    article_text = fetch_response.text.split("</article>")
-    
-    values_dict = []
-    for article in article_text:
-        values = bs4.BeautifulSoup(article, "xml")
-        
-        text_bs = values.find('body')
-        abstract_bs = values.find('abstract')
-        title_bs = values.find('article-title')
-        pmc_id_bs = values.find('article-id', attrs={"pub-id-type":"pmc"})
+    fetch_response = _SESSION.post(fetch_url, data=fetch_payload, timeout=120, stream=True)
+    fetch_response.raise_for_status() # recover=True below would parse error pages as 0 articles
+    fetch_response.raw.decode_content = True
 
-        text = text_bs.get_text() if text_bs is not None else ""
-        abstract = abstract_bs.get_text() if abstract_bs is not None else ""
-        title = title_bs.get_text() if title_bs is not None else ""
-        pmc_id = pmc_id_bs.get_text() if pmc_id_bs is not None else ""
+    # Stream articles out of the XML response, clearing each one after use
+    # so only a single article is held in memory at a time
+    values_dict = []
+    with fetch_response:
+        context = etree.iterparse(fetch_response.raw, tag="article", recover=True, huge_tree=True)
+        for _, values in context:
+            values_dict.append(_parse_article(values))
 
-        values_dict.append({"pmc_id":pmc_id, "title" : title, "text":text, "abstract":abstract})
+            values.clear()
+            while values.getprevious() is not None:
+                del values.getparent()[0]
 
     return values_dict
 
-
-
+def _parse_article(article):
+    """
+    Extract PMC id, title, full text, and abstract from a single <article> element
+    """
+    return {"pmc_id":_X_PMC_ID(article), "title" : _X_TITLE(article), 
+            "text":_X_BODY(article), "abstract":_X_ABSTRACT(article)}
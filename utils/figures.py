@@ -1,27 +1,26 @@
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.colors as mcolors
-import matplotlib.cm as cm
-
-import seaborn as sns
 
 import regex as re
 
+# matplotlib, seaborn, and scipy are imported inside the plotting functions
+# so the text/table helpers can be used without loading the plotting stack
+
 def mask_small_group(demographics, min_n=10):
     """
     Masks counts of groups with less than min_n values and excludes them from proportion calculations
     
     """
-    mask_values = demographics[demographics["count"]<min_n]
-    mask_values["count"] = "<10"
-    mask_values["proportion"] = np.nan
-    
+    total = demographics["count"].sum()
+    mask = demographics["count"] < min_n
+
     # get masked proportions
-    all_values = demographics[demographics["count"]>=min_n]
-    all_values["proportion"] = all_values["count"] / demographics["count"].sum()
+    masked_df = demographics.copy()
+    masked_df["proportion"] = masked_df["count"].where(~mask) / total
+    masked_df["count"] = masked_df["count"].astype(object)
+    masked_df.loc[mask, "count"] = "<%d"%min_n
     
-    return pd.concat([all_values, mask_values])
+    return masked_df
 
 def retrieve_dh_sentences(notes, term, extend=True):
     """
@@ -45,26 +44,20 @@ def retrieve_dh_sentences(notes, term, extend=True):
     dh_sentences = []
     regexp = re.compile(term)
 
-    if extend: # get DH sentence and sentence before/after
-        for curr_note in notes:
-            curr_sent = []
-            
-            for i, sentence in enumerate(curr_note):
-                if regexp.search(sentence):
-                    curr_sent.append(sentence)
-
-                    if i > 0:
-                        curr_sent.append(curr_note[i-1])
-                    if i < len(curr_note)-1:
-                        curr_sent.append(curr_note[i+1])
-                
-            dh_sentences.append(list(set(curr_sent)))
-
-        return dh_sentences
-    else:
-        for curr_note in notes:
-            curr_sent = [sentence for sentence in curr_note if regexp.search(sentence)]
-            dh_sentences.append(curr_sent)
+    for curr_note in notes:
+        # search each sentence once into a boolean mask of hits
+        sents = np.asarray(curr_note, dtype=object)
+        hits = np.fromiter((regexp.search(sentence) is not None for sentence in sents), 
+                           dtype=bool, count=len(sents))
+
+        if extend: # get DH sentence and sentence before/after
+            keep = hits.copy()
+            keep[1:] |= hits[:-1]
+            keep[:-1] |= hits[1:]
+        else:
+            keep = hits
+
+        dh_sentences.append(sents[keep].tolist())
     
     return dh_sentences
 
@@ -86,7 +79,7 @@ def plot_notes_over_time(notes_df, time_col="year", hue="encounter_department_sp
         The column name of the count you want to plot.
     top_n: int
         The number of top values you want to plot.
-    TODO: add_total: bool
+    add_total: bool
         Whether to add a line for overall values
     
     Returns:
@@ -99,20 +92,29 @@ def plot_notes_over_time(notes_df, time_col="year", hue="encounter_department_sp
     notes_over_time(hue="encounter_department_specialty", hue_label="Department specialty", count="encounterkey", top_n=10)
     
     """
-    values_df = notes_df.groupby([time_col, hue])[count].count().reset_index()
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    # categorical hue groups on integer codes instead of hashing strings
+    if notes_df[hue].dtype == object:
+        notes_df = notes_df.assign(**{hue: notes_df[hue].astype("category")})
+
+    ## Only aggregate counts for top categories
+    top_values = notes_df[hue].value_counts().nlargest(top_n).index
+    top_df = notes_df.loc[notes_df[hue].isin(top_values), [time_col, hue]]
+
+    values_df = top_df.groupby([time_col, hue], observed=True).size().reset_index(name=count)
     values_df = values_df.sort_values(count, ascending=False)
     values_df.columns = ["Year", hue_label, "Count"]
+    values_df[hue_label] = values_df[hue_label].astype(object) # drop unused categories from legend
+    plot_df = values_df
 
     # Add totals
-    total_df = notes_df.groupby([time_col])[count].count().reset_index()
-    total_df[hue_label] = "Total"
-    total_df.columns = ["Year", "Count", hue_label]
-    total_df = total_df[["Year", hue_label, "Count"]]
-    plot_df = pd.concat([total_df, values_df])
-
-    ## Plot counts for top categories
-    top_values = list(notes_df.value_counts(hue).sort_values(ascending=False)[:top_n].index)
-    plot_df = plot_df[plot_df[hue_label].isin(top_values)]
+    if add_total:
+        total_df = notes_df.groupby([time_col]).size().reset_index(name="Count")
+        total_df = total_df.rename(columns={time_col:"Year"}).assign(**{hue_label:"Total"})
+        total_df = total_df[["Year", hue_label, "Count"]]
+        plot_df = pd.concat([total_df, values_df], ignore_index=True)
 
     fig, ax = plt.subplots(figsize=(12,8))
     ax = sns.lineplot(data=plot_df, x="Year", y="Count", hue=hue_label, **kwargs)
@@ -145,15 +147,15 @@ def calculate_cagr(values_df, group_col, time_col="Year", count_col="Count"):
     -------
     notes_cagr(group_col="Department specialty", time_col="Year", count_col="Count")
     """
-    xtab_df = pd.crosstab(index=values_df[time_col], columns=values_df[group_col], 
-                      values=values_df[count_col], aggfunc=np.sum, normalize=False)
-    counts = xtab_df.sum(axis=0) # get counts before changing values
-    xtab_df = xtab_df.replace(np.nan,1)
-    xtab_df = xtab_df.replace(0,1)
+    counts = values_df.groupby(group_col)[count_col].sum() # get counts before filling values
+    xtab_df = pd.pivot_table(values_df, index=time_col, columns=group_col, 
+                             values=count_col, aggfunc="sum", fill_value=1)
+    xtab_df = xtab_df.mask(xtab_df == 0, 1)
 
     # Calculate compound annual growth rate (CAGR)
-    cagr_df = xtab_df.pct_change().add(1).prod().pow(1./(len(xtab_df.index) - 1)).sub(1)*100
-    cagr_df.sort_values()[-20:]
+    # product of yearly growth telescopes to last/first
+    n_periods = len(xtab_df.index) - 1
+    cagr_df = (xtab_df.iloc[-1] / xtab_df.iloc[0]).pow(1./n_periods).sub(1)*100
 
     cagr_df = cagr_df.reset_index()
     cagr_df["Count"] = cagr_df[group_col].map(counts)
@@ -164,6 +166,44 @@ def calculate_cagr(values_df, group_col, time_col="Year", count_col="Count"):
     return cagr_df
 
 
+def _ridge_kde(x, weights, data, color, clip=(2011, 2022), bw_adjust=.4, **kwargs):
+    """
+    Draws a filled density with a white outline for one row of ridge_plot
+    
+    Parameters
+    ----------
+    x : str
+        The name of the column to estimate the density of.
+    weights : str
+        The name of the column containing the weight of each x value.
+    data : pd.DataFrame
+        Values for the current row, passed by FacetGrid.map_dataframe
+    color : color
+        Fill color for the current row, passed by FacetGrid.map_dataframe
+    clip : tuple
+        Range of x values to evaluate the density over.
+    bw_adjust : float
+        Factor to scale the default (Scott) bandwidth by, as in sns.kdeplot
+    """
+    import matplotlib.pyplot as plt
+    from scipy.stats import gaussian_kde
+
+    values = data[x].to_numpy(dtype=float)
+    counts = data[weights].to_numpy(dtype=float)
+
+    # density is undefined for a single value, sns.kdeplot also skips these
+    if len(np.unique(values)) < 2 or counts.sum() <= 0:
+        return
+
+    kde = gaussian_kde(values, weights=counts)
+    kde.set_bandwidth(kde.factor * bw_adjust)
+    grid = np.linspace(clip[0], clip[1], 256)
+    density = kde(grid)
+
+    ax = plt.gca()
+    ax.fill_between(grid, density, color=color, alpha=0.9, linewidth=1.5, clip_on=False)
+    ax.plot(grid, density, color="w", lw=2, clip_on=False)
+
 def ridge_plot(plot_df, hue, order, pal, vmin=None, vmax=None):
     """
     Ridge plot of density over time
@@ -185,13 +225,18 @@ def ridge_plot(plot_df, hue, order, pal, vmin=None, vmax=None):
         The function creates the ridge plots and displays them.
     """
     
+    import matplotlib.pyplot as plt
+    import matplotlib.cm as cm
+    import seaborn as sns
+
     # Get colors
     vmin = plot_df['CAGR'].min() if vmin is None else vmin
     vmax = plot_df['CAGR'].max() if vmin is None else vmax
     normalize = plt.Normalize(vmin=vmin, vmax=vmax)
 
-    plot_df["color"] = [c for c in pal(normalize(plot_df['CAGR']))]
-    plot_df["color_hex"]= [mcolors.rgb2hex(c) for c in plot_df["color"] ]
+    rgba = pal(normalize(plot_df['CAGR'].to_numpy())) # (N, 4) array
+    rgb255 = (rgba[:, :3] * 255 + 0.5).astype(np.uint8)
+    plot_df["color_hex"] = ["#%02x%02x%02x"%tuple(rgb) for rgb in rgb255]
     hue_to_color = dict(zip(plot_df[hue], plot_df["color_hex"], ))
     discrete_pal = sns.color_palette([hue_to_color[o] for o in order])
 
@@ -199,14 +244,8 @@ def ridge_plot(plot_df, hue, order, pal, vmin=None, vmax=None):
     g = sns.FacetGrid(plot_df, row=hue, hue=hue, aspect=8.2, row_order=order,
                       height=0.75, palette=discrete_pal, hue_order=order) #,  #, palette=pal
 
-    # Draw the densities in a few steps
-    kdeargs = {"weights":"Count", "clip":[2011,2022],#"hue": "CAGR", 
-               "palette":plot_df["color"], "hue_order": order}
-
-    g.map_dataframe(sns.kdeplot, "Year", bw_adjust=.4, clip_on=False,
-                    fill=True, alpha=0.9, linewidth=1.5, **kdeargs)
-    g.map_dataframe(sns.kdeplot, "Year", clip_on=False, color="w", 
-                    lw=2, bw_adjust=.4, **kdeargs)
+    # Draw the densities, fitting each row's KDE once for the fill and outline
+    g.map_dataframe(_ridge_kde, "Year", "Count", clip=(2011, 2022), bw_adjust=.4)
 
     # passing color=None to refline() uses the hue mapping
     g.refline(y=0, linewidth=2, linestyle="-", color=None, clip_on=False)